@@ -1,5 +1,6 @@
-from base import LamentConfig
-from config import ConfigFile
+from base import LamentConfig, UpdateReport
+from config import ConfigFile, ConfigShards
+from layers import ConfigLayer
 from meta import config, regex_config, export
 
-__all__ = ['LamentConfig', 'ConfigFile', 'config', 'regex_config', 'export']
+__all__ = ['LamentConfig', 'UpdateReport', 'ConfigFile', 'ConfigShards', 'ConfigLayer', 'config', 'regex_config', 'export']
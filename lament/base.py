@@ -1,7 +1,10 @@
-from re import match
-from config import ConfigFile
+import os.path
+from copy import copy, deepcopy
+from collections import deque, defaultdict, namedtuple
+from config import ConfigFile, ConfigShards
 from meta import ConfigMeta
-from collections import defaultdict
+from layers import ConfigLayer, LayerChain, SectionView, IMMUTABLE, _MISSING
+from persistent import PersistentDict
 
 def _get_instances(types, values):
     # Each option should start with an instance of it's type
@@ -15,12 +18,69 @@ def _get_instances(types, values):
 
     return defaults
 
+# What became of the keys passed to update_from_items, either counts or
+# lists of keys
+UpdateReport = namedtuple(
+        'UpdateReport',
+        ['applied', 'rejected', 'deleted', 'declined']
+        )
+
+# Everything needed to put a config back the way it was
+_Version = namedtuple(
+        '_Version',
+        ['layers', 'local', 're_local', 'raw', 'shadow', 'changes']
+        )
+
+def _from_json(val):
+    # JSON produces unicode instead of str
+    if isinstance(val, unicode):
+        return str(val)
+    return val
+
+def _own(view, key):
+    # Handlers may modify old values in place, but the current value may
+    # belong to a lower layer or a previous version, so hand over a copy
+    val = view.get(key, None)
+    if val is None or isinstance(val, IMMUTABLE):
+        return val
+    return copy(val)
+
 class LamentConfig(object):
     __metaclass__ = ConfigMeta
 
+    # How many previous versions to keep around for rollback
+    history_size = 10
+
     def __init__(self, **kwargs):
-        self._config = _get_instances(self._defaults, self._default_values)
-        self._re_config = defaultdict(dict)
+        self._base = _get_instances(self._defaults, self._default_values)
+        self._layers = []
+        self._local = PersistentDict()
+        self._re_local = {key: PersistentDict() for key in self._re_keys}
+
+        # Latest raw input behind each runtime value that a handler made
+        # something else of, so it can be re-evaluated when a layer beneath
+        # it changes. Where the handler just kept the input, the runtime
+        # value itself stands in for it.
+        self._raw = PersistentDict()
+
+        # Options read through attribute access since the last version,
+        # whose runtime value we therefore own and can hand out directly,
+        # and those whose runtime value is only a copy of a lower one
+        self._working = set()
+        self._shadow = set()
+
+        self._versions = deque(maxlen=self.history_size + 1)
+
+        # Regex (key, sub) pairs changed since the last version, and since
+        # the last time we were in sync with a sharded config directory
+        self._changes = set()
+        self._dirty = set()
+        self._synced = None
+
+        # The (key, shard) pairs we hold of the directory we're synced with
+        self._loaded = set()
+
+        self._restack()
         self.update(**kwargs)
 
     @classmethod
@@ -29,72 +89,547 @@ class LamentConfig(object):
         temp.update_from_file(file_path)
         return temp
 
+    @classmethod
+    def from_layers(cls, *layers):
+        """Start a new config on top of layers taken from another config.
+
+        The layers are shared rather than copied, so they must come (in
+        order) from an instance of the same class.
+        """
+        temp = cls()
+        temp._layers = list(layers)
+        temp._restack()
+        temp._versions.clear()
+        temp._commit()
+        return temp
+
     def update_from_file(self, file_path):
+        if ConfigShards.is_sharded(file_path):
+            self.update_from_shards(file_path)
+            return
+
         try:
             with ConfigFile(file_path) as inp:
-                self.update(**inp)
+                self.update_from_items(inp)
         except Exception:
             pass
 
+    def update_from_shards(self, config_dir, sections=None, shards=None):
+        """Load a sharded config directory, or just part of it.
+
+        `sections` limits which regex sections are read and `shards`
+        which of their shard files; regular options are always read.
+        Exporting back to a partly loaded directory only ever patches the
+        shards holding changed sub keys, everything else is left alone.
+        """
+        store = ConfigShards(config_dir)
+        if sections is None:
+            sections = store.sections
+        if shards is None:
+            shards = range(store.shards)
+
+        # Loading leaves us in sync with the directory either way. Anything
+        # we held before loading from a different one counts as changed,
+        # so exporting back only ever patches it into the shards.
+        path = os.path.abspath(config_dir)
+        loaded = set((key, index) for key in sections for index in shards)
+        if self._synced == path:
+            loaded |= self._loaded
+            dirty = self._dirty | self._changes
+        else:
+            dirty = set((key, sub)
+                    for key in self._re_keys
+                    for sub in self._re_config[key])
+
+        self._dispatch(
+                self._config,
+                self._re_config,
+                store.read_options().iteritems(),
+                True
+                )
+
+        for key in sections:
+            if key not in self._re_keys:
+                continue
+            section = self._re_config[key]
+            handler = getattr(self, '_re_con_%s' % key)
+            for index in shards:
+                for sub, val in store.read_shard(key, index).iteritems():
+                    if self._re_match(key, sub):
+                        self._apply_regex(section, key, handler, sub, val, True)
+        self._commit()
+
+        self._synced = path
+        self._loaded = loaded
+        self._dirty = dirty
+
     def update(self, **kwargs):
-        for key, val in kwargs.iteritems():
-            # JSON produces unicode instead of str
-            if isinstance(val, unicode):
-                val = str(val)
-
-            # Regular key
-            if key in self._config_keys:
-                self._config[key] = getattr(self, '_con_%s' % key)(
-                        self._config[key],
-                        val
+        return self.update_from_items(kwargs)
+
+    def update_from_items(self, items, keys=False):
+        """Update from a mapping or any iterable of (key, value) pairs.
+
+        Keys are either option names, 'key sub' strings or (key, sub)
+        tuples for regex options. Pairs are applied as they're read, so a
+        generator is never copied into a dict or list first.
+
+        Returns an UpdateReport counting how many keys were applied,
+        rejected (not valid keys at all), deleted or declined (the handler
+        returned None for a sub key that wasn't there to delete). With
+        `keys=True` it lists the keys instead, which costs memory in
+        proportion to the input.
+        """
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        report = self._dispatch(
+                self._config, self._re_config, items, True, keys
+                )
+        self._commit()
+        return report
+
+    def rollback(self, n=1):
+        """Go back to the version from `n` changes ago.
+
+        Nothing is re-evaluated, the old version is simply put back. Use
+        `rollback(0)` to undo an update that failed half way through.
+        """
+        if not 0 <= n < len(self._versions):
+            raise IndexError(
+                    "Only %d previous versions are available." % (
+                        len(self._versions) - 1
+                        )
+                    )
+
+        # Whatever changed in the versions we drop is changing back again
+        self._dirty.update(self._changes)
+        self._changes = set()
+        for _ in range(n):
+            self._dirty.update(self._versions.pop().changes)
+        version = self._versions[-1]
+
+        self._layers = list(version.layers)
+        self._local = version.local.copy()
+        self._re_local = {key: val.copy()
+                for key, val in version.re_local.iteritems()}
+        self._raw = version.raw.copy()
+        self._shadow = set(version.shadow)
+        self._working = set()
+        self._restack()
+
+    def _commit(self):
+        # Both the layers and the persistent dicts share structure with
+        # the live config, so a version only costs what changes after it
+        self._versions.append(_Version(
+            tuple(self._layers),
+            self._local.copy(),
+            {key: val.copy() for key, val in self._re_local.iteritems()},
+            self._raw.copy(),
+            frozenset(self._shadow),
+            self._changes,
+            ))
+        self._working = set()
+        self._dirty.update(self._changes)
+        self._changes = set()
+
+    @property
+    def layers(self):
+        return tuple(self._layers)
+
+    def add_layer(self, name, values):
+        """Push a new layer on top of the existing ones.
+
+        Values set with `update` still take precedence over every layer,
+        and are re-evaluated on top of it if it defines the same keys.
+        """
+        if any(layer.name == name for layer in self._layers):
+            raise ValueError("There's already a layer called '%s'." % name)
+
+        layer = self._evaluate(name, values, self._layers)
+        self._layers.append(layer)
+        self._restack()
+        self._replay(self._parsed_keys(layer.values))
+        self._commit()
+        return layer
+
+    def add_layer_from_file(self, name, file_path):
+        values = {}
+        try:
+            with ConfigFile(file_path) as inp:
+                values = inp
+        except Exception:
+            pass
+        return self.add_layer(name, values)
+
+    def replace_layer(self, name, values):
+        """Swap out the values of one layer.
+
+        Only the keys defined by the old or new values are re-evaluated,
+        both in this layer and in any layer above (or values set with
+        `update`) that define them too.
+        """
+        index = self._layer_index(name)
+        old = self._layers[index]
+        new = self._evaluate(name, values, self._layers[:index])
+        self._restack_from(index, new, self._parsed_keys(old.values, values))
+        return new
+
+    def replace_layer_from_file(self, name, file_path):
+        values = {}
+        try:
+            with ConfigFile(file_path) as inp:
+                values = inp
+        except Exception:
+            pass
+        return self.replace_layer(name, values)
+
+    def remove_layer(self, name):
+        index = self._layer_index(name)
+        old = self._layers[index]
+        self._restack_from(index, None, self._parsed_keys(old.values))
+
+    def _layer_index(self, name):
+        for index, layer in enumerate(self._layers):
+            if layer.name == name:
+                return index
+        raise KeyError("Couldn't find layer '%s'." % name)
+
+    def _restack_from(self, index, layer, changed):
+        self._changes.update(key for key in changed if key[1] is not None)
+
+        layers = self._layers[:index]
+        if layer is not None:
+            layers.append(layer)
+
+        # Layers above only need to be rebuilt if they define changed keys
+        for above in self._layers[index + 1:]:
+            keys = [key for key in above.values
+                    if self._parse_key(key) in changed]
+            if keys:
+                above = self._evaluate(
+                        above.name, above.values, layers, above, keys
                         )
+            layers.append(above)
+
+        self._layers = layers
+        self._restack()
+        self._replay(changed)
+        self._commit()
+
+    def _replay(self, keys):
+        # Re-evaluate runtime values on top of whatever the layers now hold
+        # for them. Only the latest raw input for each key is kept, so
+        # that's all that gets re-applied.
+        for key in keys:
+            opt, sub = key
+            if sub is None:
+                local = self._local
+            else:
+                section = self._re_config[opt]
+                local = section.maps[0]
+
+            raw = self._raw.get(key, _MISSING)
+            if raw is _MISSING:
+                # A copy made for attribute access just goes stale
+                if sub is None and opt in self._shadow:
+                    self._local.pop(opt, None)
+                    self._shadow.discard(opt)
+                    continue
+                raw = local.get(opt if sub is None else sub, _MISSING)
+                if raw is _MISSING:
+                    continue
+
+            if sub is None:
+                local.pop(opt, None)
+                self._apply_option(self._config, opt, raw, True)
+            else:
+                local.pop(sub, None)
+                handler = getattr(self, '_re_con_%s' % opt)
+                self._apply_regex(section, opt, handler, sub, raw, True)
+
+    def _evaluate(self, name, values, below, carry=None, keys=None):
+        """Run raw `values` through the handlers on top of `below`.
+
+        When rebuilding an existing layer, pass it as `carry` along with
+        the raw `keys` to re-evaluate; all its other parsed values are
+        reused as they are.
+        """
+        values = dict(values)
+        if keys is None:
+            keys = values.keys()
+
+        config = {}
+        re_config = {}
+        if carry is not None:
+            config.update(carry.config)
+            re_config.update(carry.re_config)
+
+        # Sections we're about to write to have to be ours, not carry's
+        copied = set()
+        for opt, sub in self._parsed_keys(keys):
+            if sub is None:
+                config.pop(opt, None)
                 continue
+            if opt not in copied:
+                re_config[opt] = dict(re_config.get(opt, {}))
+                copied.add(opt)
+            re_config[opt].pop(sub, None)
+
+        for key in self._re_keys:
+            re_config.setdefault(key, {})
+
+        con, re_con = self._views(below, config, re_config)
+        self._dispatch(con, re_con, ((key, values[key]) for key in keys))
+
+        re_config = {key: val for key, val in re_config.iteritems() if val}
+        return ConfigLayer(name, values, config, re_config)
+
+    def _views(self, layers, config, re_config):
+        below = list(reversed(layers))
+        con = LayerChain(
+                [config] + [layer.config for layer in below] + [self._base]
+                )
+        re_con = {}
+        for key in self._re_keys:
+            re_con[key] = LayerChain([re_config[key]] + [
+                layer.re_config[key]
+                for layer in below
+                if key in layer.re_config
+                ])
+        return con, re_con
 
-            # Regex key
-            split_key = key.split()
-            if len(split_key) == 2:
-                key, sub = split_key
-                if self._re_match(key, sub):
-                    new = getattr(self, '_re_con_%s' % key)(
-                            self._re_oldval(key, sub),
-                            val
+    def _restack(self):
+        self._config, self._re_config = self._views(
+                self._layers, self._local, self._re_local
+                )
+
+    def _parsed_keys(self, *value_sets):
+        keys = set()
+        for values in value_sets:
+            keys.update(self._parse_key(key) for key in values)
+        keys.discard(None)
+        return keys
+
+    def _parse_key(self, key):
+        # Regex key that's already been split up
+        if isinstance(key, tuple):
+            if (len(key) == 2 and isinstance(key[0], basestring)
+                    and isinstance(key[1], basestring)
+                    and self._re_match(*key)):
+                return key
+            return None
+
+        # Anything else that isn't a string can't be a key
+        if not isinstance(key, basestring):
+            return None
+
+        # Regular key
+        if key in self._config_keys:
+            return key, None
+
+        # Regex key, exactly two whitespace separated parts
+        split_key = key.split()
+        if len(split_key) == 2:
+            key, sub = split_key
+            if self._re_match(key, sub):
+                return key, sub
+
+        return None
+
+    def _dispatch(self, config, re_config, items, record=False, keys=False):
+        # Entries are applied as they're read rather than buffered up, but
+        # each regex section's view and handler are only looked up once
+        if keys:
+            results = {'applied': [], 'rejected': [], 'deleted': [],
+                    'declined': []}
+        else:
+            results = {'applied': 0, 'rejected': 0, 'deleted': 0,
+                    'declined': 0}
+        sections = {}
+
+        for key, val in items:
+            parsed = self._parse_key(key)
+            if parsed is None:
+                status = 'rejected'
+            else:
+                name, sub = parsed
+                if sub is None:
+                    self._apply_option(config, name, val, record)
+                    status = 'applied'
+                else:
+                    if name not in sections:
+                        sections[name] = (
+                                re_config[name],
+                                getattr(self, '_re_con_%s' % name),
+                                )
+                    section, handler = sections[name]
+                    status = self._apply_regex(
+                            section, name, handler, sub, val, record
                             )
 
-                    # If new val is None, take it out of config
-                    if new is None and sub in self._re_config[key]:
-                        del self._re_config[key][sub]
-                    elif new is not None:
-                        self._re_config[key][sub] = new
+            if keys:
+                results[status].append(key)
+            else:
+                results[status] += 1
+
+        return UpdateReport(**results)
+
+    def _read_option(self, name):
+        # Options are handed out live, so changes made through them stick.
+        # But a value shared with a layer or a previous version has to be
+        # copied into the runtime overlay first, once per version.
+        val = self._config[name]
+        if val is None or isinstance(val, IMMUTABLE) or name in self._working:
+            return val
+
+        val = deepcopy(val)
+        if name not in self._local:
+            self._shadow.add(name)
+        self._local[name] = val
+        self._working.add(name)
+        return val
+
+    def _read_section(self, name):
+        return SectionView(self, name)
+
+    def _apply_option(self, config, key, val, record=False):
+        val = _from_json(val)
+        new = getattr(self, '_con_%s' % key)(_own(config, key), val)
+        config[key] = new
+
+        if record:
+            self._shadow.discard(key)
+            self._record((key, None), val, new)
+
+    def _record(self, key, val, new):
+        # Only keep raw input the handler didn't simply hand back, see
+        # self._raw
+        if new is None or new is not val:
+            self._raw[key] = val
+        elif key in self._raw:
+            del self._raw[key]
+
+    def _apply_regex(self, section, key, handler, sub, val, record=False):
+        # This runs for every regex entry in a bulk load, so _own and
+        # _from_json are inlined here
+        old = section.get(sub)
+        if old is not None and not isinstance(old, IMMUTABLE):
+            old = copy(old)
+        if isinstance(val, unicode):
+            val = str(val)
+        new = handler(old, val)
+
+        if record:
+            self._record((key, sub), val, new)
+
+        # If new val is None, take it out of config
+        if new is not None:
+            section.maps[0][sub] = new
+            status = 'applied'
+        elif sub in section:
+            del section[sub]
+            status = 'deleted'
+        else:
+            return 'declined'
+
+        self._changes.add((key, sub))
+        return status
 
     def _re_match(self, key, sub):
-        return key in self._re_keys and match(self._re_patterns[key], sub)
+        matcher = self._re_matchers.get(key)
+        return matcher is not None and matcher(sub)
 
-    def _re_oldval(self, key, sub):
-        return self._re_config[key].get(sub, None)
+    def export_to_file(self, file_path, shards=None):
+        if shards is not None or os.path.isdir(file_path):
+            self.export_to_shards(file_path, shards)
+            return
 
-    def export_to_file(self, file_path):
         with ConfigFile(file_path, True) as outp:
             outp.clear() # We want to overwrite the file, not update
             outp.update(self.export())
 
-    def export(self):
-        temp = {}
-        for key in self._config_keys:
-            if key in self._export_keys:
-                temp[key] = getattr(self, '_ex_%s' % key)(
-                        self._config[key]
+    def export_to_shards(self, config_dir, shards=None):
+        """Write config out as a sharded directory (see ConfigShards).
+
+        If we're still in sync with `config_dir` since it was last loaded
+        or exported, only shards holding changed sub keys are rewritten.
+        """
+        store = ConfigShards(config_dir, True, shards)
+        path = os.path.abspath(config_dir)
+        incremental = not store.fresh and self._synced == path
+
+        # Anything else rewrites every shard, which would lose whatever
+        # wasn't loaded from a directory that's already there
+        if not incremental and ConfigShards.is_sharded(config_dir):
+            current = ConfigShards(config_dir)
+            everything = set(
+                    (key, index)
+                    for key in current.sections
+                    for index in range(current.shards)
+                    )
+            if self._synced != path or everything - self._loaded:
+                raise Exception(
+                        "%s wasn't fully loaded, so it can't be rewritten" % (
+                            config_dir
+                            )
                         )
-            else:
-                temp[key] = self._config[key]
+
+        # Flatten each section once rather than reading through the layers
+        # for every sub key
+        sections = {key: self._re_config[key].merged() for key in self._re_keys}
+
+        with store.options() as outp:
+            outp.clear()
+            outp.update(self._export_options())
+
+        if incremental:
+            changed = defaultdict(list)
+            for key, sub in self._dirty | self._changes:
+                changed[key, store.shard_of(sub)].append(sub)
+        else:
+            changed = defaultdict(list)
+            for key in self._re_keys:
+                for index in range(store.shards):
+                    changed[key, index] = []
+                for sub in sections[key]:
+                    changed[key, store.shard_of(sub)].append(sub)
+
+        for (key, index), subs in changed.iteritems():
+            with store.shard(key, index) as outp:
+                if not incremental:
+                    outp.clear()
+                section = sections[key]
+                for sub in subs:
+                    if sub in section:
+                        outp[sub] = self._export_value(key, section[sub])
+                    else:
+                        outp.pop(sub, None)
+
+        store.save_manifest()
+        self._synced = path
+        self._dirty = set()
+        if not incremental:
+            self._loaded = set(changed)
+
+    def export(self):
+        temp = self._export_options()
 
         for key in self._re_keys:
-            for sub in self._re_config[key].iterkeys():
-                full_key = '%s %s' % (key, sub)
-                if key in self._export_keys:
-                    temp[full_key] = getattr(self, '_ex_%s' % key)(
-                            self._re_config[key][sub]
-                            )
-                else:
-                    temp[full_key] = self._re_config[key][sub]
+            section = self._re_config[key].merged()
+            if key in self._export_keys:
+                exporter = getattr(self, '_ex_%s' % key)
+                temp.update(('%s %s' % (key, sub), exporter(val))
+                        for sub, val in section.iteritems())
+            else:
+                temp.update(('%s %s' % (key, sub), val)
+                        for sub, val in section.iteritems())
 
         return temp
+
+    def _export_options(self):
+        return {key: self._export_value(key, self._config[key])
+                for key in self._config_keys}
+
+    def _export_value(self, key, val):
+        if key in self._export_keys:
+            return getattr(self, '_ex_%s' % key)(val)
+        return val
@@ -1,6 +1,7 @@
 import json
 import os
 import os.path
+from zlib import crc32
 
 class ConfigFile(object):
     def __init__(self, config_path, create=False):
@@ -31,3 +32,88 @@ class ConfigFile(object):
         if os.path.isfile(self.path) or self.create:
             with open(self.path, 'w') as outp:
                 json.dump(self.config, outp, indent=4)
+
+def _read(path):
+    # Unlike ConfigFile this never writes anything back
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as inp:
+        try:
+            return json.load(inp)
+        except ValueError:
+            return {}
+
+class ConfigShards(object):
+    """Config stored as a directory rather than a single file.
+
+    Regular options live in one ConfigFile, while each regex section is
+    split across a fixed number of shard files by hashing its sub keys.
+    A manifest records the number of shards and which sections exist, so
+    a section (or one shard of it) can be read or rewritten on its own.
+    """
+    MANIFEST = 'manifest.json'
+    OPTIONS = 'config.json'
+    DEFAULT_SHARDS = 64
+
+    def __init__(self, config_dir, create=False, shards=None):
+        self.path = config_dir
+        manifest = _read(os.path.join(config_dir, self.MANIFEST))
+
+        if manifest:
+            self.shards = manifest['shards']
+            self.sections = set(manifest['sections'])
+        elif create:
+            head = os.path.dirname(os.path.abspath(config_dir))
+            if not os.path.isdir(head):
+                raise Exception("%s doesn't exist" % head)
+            self.shards = None
+            self.sections = set()
+        else:
+            raise Exception("%s isn't a sharded config" % config_dir)
+
+        # Asking for a different number of shards means starting over
+        self.fresh = self.shards is None or (
+                shards is not None and shards != self.shards
+                )
+        if self.fresh:
+            self.shards = shards or self.DEFAULT_SHARDS
+
+    @staticmethod
+    def is_sharded(config_dir):
+        return os.path.isfile(os.path.join(config_dir, ConfigShards.MANIFEST))
+
+    def shard_of(self, sub):
+        if isinstance(sub, unicode):
+            sub = sub.encode('utf-8')
+        return (crc32(sub) & 0xffffffff) % self.shards
+
+    def read_options(self):
+        return _read(os.path.join(self.path, self.OPTIONS))
+
+    def read_shard(self, section, index):
+        return _read(self._shard_path(section, index))
+
+    def options(self):
+        self._make_dirs()
+        return ConfigFile(os.path.join(self.path, self.OPTIONS), True)
+
+    def shard(self, section, index):
+        self._make_dirs(section)
+        self.sections.add(section)
+        return ConfigFile(self._shard_path(section, index), True)
+
+    def save_manifest(self):
+        self._make_dirs()
+        with ConfigFile(os.path.join(self.path, self.MANIFEST), True) as outp:
+            outp.clear()
+            outp['shards'] = self.shards
+            outp['sections'] = sorted(self.sections)
+        self.fresh = False
+
+    def _shard_path(self, section, index):
+        return os.path.join(self.path, section, '%04d.json' % index)
+
+    def _make_dirs(self, section=None):
+        path = self.path if section is None else os.path.join(self.path, section)
+        if not os.path.isdir(path):
+            os.makedirs(path)
@@ -0,0 +1,173 @@
+from copy import deepcopy
+from collections import Mapping, MutableMapping
+from persistent import PersistentDict
+
+class _Deleted(object):
+    def __repr__(self):
+        return '<deleted>'
+
+# Marks a key that was removed on top of a layer that still defines it
+DELETED = _Deleted()
+
+_MISSING = object()
+
+# Values nobody can modify in place, so there's no need to copy them
+IMMUTABLE = (str, unicode, int, long, float, bool, tuple, frozenset)
+
+def _copied(val):
+    if val is None or isinstance(val, IMMUTABLE):
+        return val
+    return deepcopy(val)
+
+class LayerChain(MutableMapping):
+    """Read-through view over a list of dicts, searched front to back.
+
+    Nothing is copied, lookups simply walk `maps` until one of them has the
+    key. Writes only ever touch the first map; deleting a key that a lower
+    map still defines leaves a tombstone in the first map to hide it.
+    """
+
+    def __init__(self, maps):
+        self.maps = maps
+
+    def get(self, key, default=None):
+        for mapping in self.maps:
+            val = mapping.get(key, _MISSING)
+            if val is not _MISSING:
+                return default if val is DELETED else val
+        return default
+
+    def __getitem__(self, key):
+        val = self.get(key, _MISSING)
+        if val is _MISSING:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __setitem__(self, key, val):
+        self.maps[0][key] = val
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        if any(key in mapping for mapping in self.maps[1:]):
+            self.maps[0][key] = DELETED
+        else:
+            del self.maps[0][key]
+
+    def __iter__(self):
+        seen = set()
+        for mapping in self.maps:
+            for key, val in mapping.iteritems():
+                if key not in seen:
+                    seen.add(key)
+                    if val is not DELETED:
+                        yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __nonzero__(self):
+        return any(True for _ in self)
+
+    def merged(self):
+        """Flatten into a plain dict.
+
+        Each map is merged in once, from the bottom up, which is much
+        quicker than looking every key up through the chain.
+        """
+        temp = {}
+        for mapping in reversed(self.maps):
+            if isinstance(mapping, PersistentDict):
+                mapping.merge_into(temp)
+            else:
+                temp.update(mapping)
+
+        deleted = [key for key, val in temp.iteritems() if val is DELETED]
+        for key in deleted:
+            del temp[key]
+        return temp
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.merged())
+
+class SectionView(Mapping):
+    """Read-only view of one regex option, as given out by attribute access.
+
+    Lookups go straight through to the config's current LayerChain for
+    that option, so reading never copies the whole section. Mutable values
+    are copied on the way out, so nothing read through the view can change
+    a layer or a previous version.
+    """
+
+    def __init__(self, owner, key):
+        self._owner = owner
+        self._key = key
+
+    @property
+    def _chain(self):
+        return self._owner._re_config[self._key]
+
+    def get(self, key, default=None):
+        val = self._chain.get(key, _MISSING)
+        if val is _MISSING:
+            return default
+        return _copied(val)
+
+    def __getitem__(self, key):
+        val = self.get(key, _MISSING)
+        if val is _MISSING:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        return key in self._chain
+
+    def __iter__(self):
+        return iter(self._chain)
+
+    def __len__(self):
+        return len(self._chain)
+
+    def iteritems(self):
+        for key, val in self._chain.merged().iteritems():
+            yield key, _copied(val)
+
+    def itervalues(self):
+        for _, val in self.iteritems():
+            yield val
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.copy())
+
+class ConfigLayer(object):
+    """One named source of configuration, e.g. a site or host file.
+
+    `values` holds the raw input exactly as it was read, `config` and
+    `re_config` hold only what the handlers made of those values on top of
+    the layers beneath. All three must be treated as read-only: handlers,
+    attribute access and SectionView only ever hand out copies of them,
+    which is what lets the same base layers be shared by any number of
+    configs of one class.
+    """
+
+    def __init__(self, name, values, config, re_config):
+        self.name = name
+        self.values = values
+        self.config = config
+        self.re_config = re_config
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.name)
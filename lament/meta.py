@@ -1,3 +1,5 @@
+import re
+
 class ConfigMeta(type):
     def __new__(mcls, name, bases, cdict):
         _config_keys = []
@@ -5,14 +7,15 @@ class ConfigMeta(type):
         _default_values = {}
         _re_keys = []
         _re_patterns = {}
+        _re_matchers = {}
         _re_defaults = {}
         _export_keys = []
 
         def _getattr(self, name):
             if name in self._config_keys:
-                return self._config[name]
+                return self._read_option(name)
             if name in self._re_keys:
-                return self._re_config[name]
+                return self._read_section(name)
             else:
                 raise AttributeError(
                         "Couldn't find '%s' in schema definition." % name
@@ -33,6 +36,9 @@ class ConfigMeta(type):
                 if hasattr(value, '__lament_re_con__'):
                     _re_keys.append(key)
                     _re_patterns[key] = value.__lament_re_pattern__
+                    _re_matchers[key] = re.compile(
+                            value.__lament_re_pattern__
+                            ).match
                     _re_defaults[key] = value.__lament_re_df__
                     cdict['_re_con_%s' % key] = value
                     del cdict[key]
@@ -47,6 +53,7 @@ class ConfigMeta(type):
 
         cdict['_re_keys'] = _re_keys
         cdict['_re_patterns'] = _re_patterns
+        cdict['_re_matchers'] = _re_matchers
         cdict['_re_defaults'] = _re_defaults
 
         cdict['_export_keys']  = _export_keys
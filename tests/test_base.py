@@ -1,11 +1,14 @@
 import unittest
 
-from tempfile import NamedTemporaryFile as TF
-from json import dump
-from os import remove
+from tempfile import NamedTemporaryFile as TF, mkdtemp
+from json import dump, dumps, loads
+from os import remove, utime
+from os.path import join, getmtime
+from shutil import rmtree
 
 from meta import config, regex_config, export
-from base import LamentConfig
+from base import LamentConfig, UpdateReport
+from config import ConfigShards
 
 # Constants
 ABCD = {'a': 'b', 'c': 'd'}
@@ -416,3 +419,494 @@ class TestLamentConfig(unittest.TestCase):
         # Clean up
         remove(first)
         remove(second)
+
+class TestLayers(unittest.TestCase):
+    def test_add_layer(self):
+        temp = ExampleConfig()
+        temp.add_layer('site', {'str_type': 'site', 'list_type': 1})
+        temp.add_layer('host', {'list_type': 2, 'dict_type': ABCD})
+
+        self.assertEqual(temp.str_type, 'site')
+        self.assertEqual(temp.list_type, [1, 2])
+        self.assertEqual(temp.dict_type, ABCD)
+        self.assertEqual([layer.name for layer in temp.layers], ['site', 'host'])
+
+        # Each layer only holds what it defines, untouched by layers above
+        site, host = temp.layers
+        self.assertEqual(site.config, {'str_type': 'site', 'list_type': [1]})
+        self.assertEqual(host.config, {'list_type': [1, 2], 'dict_type': ABCD})
+
+        # Runtime updates sit above every layer
+        temp.update(str_type='runtime')
+        self.assertEqual(temp.str_type, 'runtime')
+        self.assertEqual(site.config['str_type'], 'site')
+
+    def test_regex_layers(self):
+        temp = ExampleConfig()
+        temp.add_layer('site', FIRST_RE_CONF)
+        temp.add_layer('host', SECOND_RE_CONF)
+
+        # Regex options read as read-only views, .copy() gives a dict
+        self.assertIsInstance(temp.regex_string.copy(), dict)
+        self.assertEqual(loads(dumps(temp.regex_string.copy())), ALL_VIDEOGAMES)
+        self.assertEqual(temp.regex_string.get('mario'), 'luigi')
+        self.assertIsNone(temp.regex_string.get('luigi'))
+        self.assertIn('sonic', temp.regex_string)
+        self.assertEqual(len(temp.regex_string), 2)
+        with self.assertRaises(TypeError):
+            temp.regex_string['luigi'] = 'mario'
+
+        self.assertEqual(temp.regex_string, ALL_VIDEOGAMES)
+        self.assertEqual(temp.regex_tuple, ALL_WEBSITES)
+        self.assertEqual(temp.export()['regex_tuple www.google.com'],
+                ('localhost', 443))
+
+    def test_replace_layer(self):
+        temp = ExampleConfig()
+        temp.add_layer('base', {'list_type': 1, 'str_type': 'base'})
+        temp.add_layer('host', {'list_type': 2})
+        temp.add_layer('runtime', {'bool_type': True})
+        base, host, runtime = temp.layers
+
+        temp.replace_layer('base', {'list_type': 5})
+        self.assertEqual(temp.list_type, [5, 2])
+        self.assertEqual(temp.str_type, '')
+        self.assertTrue(temp.bool_type)
+
+        # Layers that don't define changed keys are left alone
+        self.assertIs(temp.layers[2], runtime)
+        self.assertIsNot(temp.layers[1], host)
+
+        temp.remove_layer('base')
+        self.assertEqual(temp.list_type, [2])
+        self.assertEqual(len(temp.layers), 2)
+
+        with self.assertRaises(KeyError):
+            temp.remove_layer('base')
+
+    def test_runtime_reevaluated(self):
+        temp = ExampleConfig()
+        temp.add_layer('base', {'list_type': 1, 'regex_string mario': 'luigi'})
+        temp.update(list_type=2, str_type='runtime')
+        temp.update(**{'regex_string mario': 10})
+
+        temp.replace_layer('base', {'list_type': 5, 'regex_string mario': 'peach'})
+        self.assertEqual(temp.list_type, [5, 2])
+        self.assertEqual(temp.str_type, 'runtime')
+
+        # The runtime value for mario was rejected, so the layer shows
+        self.assertEqual(temp.regex_string, {'mario': 'peach'})
+
+        temp.remove_layer('base')
+        self.assertEqual(temp.list_type, [2])
+
+        # Adding a layer beneath runtime values re-evaluates them too
+        temp.add_layer('site', {'list_type': 3})
+        self.assertEqual(temp.list_type, [3, 2])
+
+        temp.rollback(2)
+        self.assertEqual(temp.list_type, [5, 2])
+
+    def test_runtime_latest_only(self):
+        temp = ExampleConfig()
+        temp.add_layer('base', {'list_type': 1})
+        for i in range(2, 100):
+            temp.update(list_type=i)
+        self.assertEqual(temp.list_type, range(1, 100))
+        self.assertEqual(len(temp._raw), 1)
+
+        # Only the latest input is run again on top of the new layer
+        temp.replace_layer('base', {'list_type': 5})
+        self.assertEqual(temp.list_type, [5, 99])
+
+    def test_duplicate_layer(self):
+        temp = ExampleConfig()
+        temp.add_layer('site', {'str_type': 'site'})
+
+        with self.assertRaises(ValueError):
+            temp.add_layer('site', {'str_type': 'again'})
+        self.assertEqual([layer.name for layer in temp.layers], ['site'])
+        self.assertEqual(temp.str_type, 'site')
+
+    def test_shared_layers(self):
+        base = ExampleConfig()
+        base.add_layer('base', {'list_type': 1, 'dict_type': ABCD})
+
+        first = ExampleConfig.from_layers(*base.layers)
+        second = ExampleConfig.from_layers(*base.layers)
+        self.assertIs(first.layers[0], second.layers[0])
+
+        # Updating one config mustn't leak into the shared layer
+        first.update(list_type=2, dict_type=EFGH)
+        self.assertEqual(first.list_type, [1, 2])
+        self.assertEqual(first.dict_type, ALL_LETTERS)
+        self.assertEqual(second.list_type, [1])
+        self.assertEqual(second.dict_type, ABCD)
+
+    def test_attribute_writes(self):
+        base = ExampleConfig()
+        base.add_layer('base', {'list_type': 1, 'dict_type': {'a': {'b': 'c'}}})
+        first = ExampleConfig.from_layers(*base.layers)
+        second = ExampleConfig.from_layers(*base.layers)
+
+        # Changes made through attributes write through to that config...
+        first.list_type.append(99)
+        first.dict_type['a']['b'] = 'changed'
+        first.dict_type['z'] = 1
+        self.assertEqual(first.list_type, [1, 99])
+        self.assertEqual(first.dict_type, {'a': {'b': 'changed'}, 'z': 1})
+
+        # ...but not to the layers it shares with others
+        self.assertEqual(second.list_type, [1])
+        self.assertEqual(second.dict_type, {'a': {'b': 'c'}})
+        self.assertEqual(base.layers[0].config['list_type'], [1])
+
+        # A copy of a layer's value goes stale once the layer changes
+        first.replace_layer('base', {'list_type': 5})
+        self.assertEqual(first.list_type, [5])
+
+        # Previous versions can't be changed through attributes either
+        temp = ExampleConfig(list_type=1, **{'regex_string mario': 'luigi'})
+        temp.update(list_type=2)
+        temp.list_type.append(3)
+        self.assertEqual(temp.list_type, [1, 2, 3])
+        temp.rollback()
+        self.assertEqual(temp.list_type, [1])
+
+        # Regex options are read-only
+        with self.assertRaises(TypeError):
+            temp.regex_string['sonic'] = 'tails'
+        self.assertEqual(temp.regex_string, RES_MARIO)
+
+    def test_delete_regex_in_layer(self):
+        class DeletingConfig(LamentConfig):
+            @regex_config('.*', str)
+            def hosts(self, config, obj):
+                if obj == '!':
+                    return None
+                return obj
+
+        temp = DeletingConfig()
+        temp.add_layer('base', {'hosts a': 'x', 'hosts b': 'y'})
+        temp.add_layer('host', {'hosts a': '!'})
+        self.assertEqual(temp.hosts, {'b': 'y'})
+        self.assertEqual(temp.export(), {'hosts b': 'y'})
+
+        temp.replace_layer('base', {'hosts c': 'z'})
+        self.assertEqual(temp.hosts, {'c': 'z'})
+
+class TestRollback(unittest.TestCase):
+    def test_rollback(self):
+        temp = ExampleConfig(list_type=1, **SUPER_MARIO)
+        temp.update(list_type=2, dict_type=ABCD)
+        temp.update(list_type=3, **SONIC_HEDGEHOG)
+
+        self.assertEqual(temp.list_type, [1, 2, 3])
+        self.assertEqual(temp.regex_string, ALL_VIDEOGAMES)
+
+        temp.rollback()
+        self.assertEqual(temp.list_type, [1, 2])
+        self.assertEqual(temp.dict_type, ABCD)
+        self.assertEqual(temp.regex_string, RES_MARIO)
+
+        temp.rollback()
+        self.assertEqual(temp.list_type, [1])
+        self.assertEqual(temp.dict_type, {})
+
+        # Updates after a rollback start a new history from there
+        temp.update(list_type=4)
+        self.assertEqual(temp.list_type, [1, 4])
+        temp.rollback()
+        self.assertEqual(temp.list_type, [1])
+
+        with self.assertRaises(IndexError):
+            temp.rollback()
+
+    def test_rollback_layers(self):
+        temp = ExampleConfig()
+        temp.add_layer('site', {'str_type': 'site'})
+        temp.add_layer('host', {'str_type': 'host'})
+        temp.replace_layer('host', {'str_type': 'bad push'})
+        self.assertEqual(temp.str_type, 'bad push')
+
+        temp.rollback()
+        self.assertEqual(temp.str_type, 'host')
+        temp.rollback(2)
+        self.assertEqual(temp.str_type, '')
+        self.assertEqual(temp.layers, ())
+
+    def test_rollback_without_handlers(self):
+        calls = []
+
+        class CountingConfig(LamentConfig):
+            @config(list)
+            def items(self, config, obj):
+                calls.append(obj)
+                config.append(obj)
+                return config
+
+        temp = CountingConfig(items=1)
+        temp.update(items=2)
+        temp.rollback()
+        self.assertEqual(temp.items, [1])
+        self.assertEqual(calls, [1, 2])
+
+    def test_history_size(self):
+        temp = ExampleConfig()
+        for i in range(ExampleConfig.history_size + 5):
+            temp.update(list_type=i)
+
+        with self.assertRaises(IndexError):
+            temp.rollback(ExampleConfig.history_size + 1)
+
+        temp.rollback(ExampleConfig.history_size)
+        self.assertEqual(temp.list_type, range(5))
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.config_dir = join(self.temp_dir, 'sharded')
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_round_trip(self):
+        before = ExampleConfig(str_type='Blah', list_int_only=1, **SUPER_MARIO)
+        before.update(**SONIC_HEDGEHOG)
+        before.export_to_file(self.config_dir, shards=4)
+
+        after = ExampleConfig.from_file(self.config_dir)
+        self.assertEqual(after.export(), before.export())
+
+    def test_partial_load(self):
+        before = ExampleConfig(str_type='Blah', **FIRST_RE_CONF)
+        before.update(**SECOND_RE_CONF)
+        before.export_to_file(self.config_dir, shards=4)
+
+        after = ExampleConfig()
+        after.update_from_shards(self.config_dir, sections=['regex_string'])
+        self.assertEqual(after.str_type, 'Blah')
+        self.assertEqual(after.regex_string, ALL_VIDEOGAMES)
+        self.assertEqual(after.regex_tuple, {})
+
+        index = ConfigShards(self.config_dir).shard_of('mario')
+        after = ExampleConfig()
+        after.update_from_shards(self.config_dir, ['regex_string'], [index])
+        self.assertIn('mario', after.regex_string)
+
+    def test_incremental_export(self):
+        routes = {'regex_string route%d' % i: 'dest%d' % i for i in range(50)}
+        before = ExampleConfig(**routes)
+        before.export_to_file(self.config_dir, shards=8)
+
+        # Backdate every shard so we can tell which get rewritten
+        store = ConfigShards(self.config_dir)
+        paths = [join(self.config_dir, 'regex_string', '%04d.json' % index)
+                for index in range(store.shards)]
+        for path in paths:
+            utime(path, (0, 0))
+
+        after = ExampleConfig.from_file(self.config_dir)
+        after.update(**{'regex_string route3': 'elsewhere'})
+        after.export_to_file(self.config_dir)
+
+        changed = store.shard_of('route3')
+        for index, path in enumerate(paths):
+            self.assertEqual(getmtime(path) != 0, index == changed)
+        shard = store.read_shard('regex_string', changed)
+        self.assertEqual(shard['route3'], 'elsewhere')
+
+        # Rolling back is just another change as far as the shards care
+        after.rollback()
+        after.export_to_file(self.config_dir)
+        shard = store.read_shard('regex_string', changed)
+        self.assertEqual(shard['route3'], 'dest3')
+
+    def test_partial_load_export(self):
+        hosts = {'regex_string host%d' % i: 'dest%d' % i for i in range(100)}
+        ExampleConfig(**hosts).export_to_file(self.config_dir, shards=4)
+
+        store = ConfigShards(self.config_dir)
+        loaded = store.shard_of('host0')
+        other = store.shard_of('host1')
+        self.assertNotEqual(loaded, other)
+
+        partial = ExampleConfig()
+        partial.update_from_shards(self.config_dir, shards=[loaded])
+        self.assertLess(len(partial.regex_string), 100)
+
+        # Change a loaded key and one from a shard that wasn't loaded
+        partial.update(**{
+            'regex_string host0': 'changed',
+            'regex_string host1': 'also changed',
+            })
+        partial.export_to_file(self.config_dir)
+
+        after = ExampleConfig.from_file(self.config_dir)
+        expected = {'host%d' % i: 'dest%d' % i for i in range(100)}
+        expected['host0'] = 'changed'
+        expected['host1'] = 'also changed'
+        self.assertEqual(after.regex_string, expected)
+
+        # Loading the rest as well makes us complete, so resharding is ok
+        with self.assertRaises(Exception):
+            partial.export_to_file(self.config_dir, shards=8)
+        partial.update_from_shards(
+                self.config_dir,
+                shards=[i for i in range(4) if i != loaded]
+                )
+        partial.export_to_file(self.config_dir, shards=8)
+        self.assertEqual(
+                ExampleConfig.from_file(self.config_dir).regex_string,
+                expected
+                )
+
+    def test_partial_load_into_existing(self):
+        hosts = {'regex_string host%d' % i: 'dest%d' % i for i in range(100)}
+        ExampleConfig(**hosts).export_to_file(self.config_dir, shards=8)
+
+        # Whatever we held before loading gets patched into the shards
+        temp = ExampleConfig(**{'regex_string new': 'x'})
+        temp.update_from_shards(self.config_dir, shards=[0])
+        temp.export_to_file(self.config_dir)
+
+        after = ExampleConfig.from_file(self.config_dir)
+        self.assertEqual(len(after.regex_string), 101)
+        self.assertEqual(after.regex_string['new'], 'x')
+
+    def test_overwrite_unloaded(self):
+        ExampleConfig(**SUPER_MARIO).export_to_file(self.config_dir, shards=4)
+
+        # Writing out a config that never loaded the directory would wipe
+        # everything in it
+        with self.assertRaises(Exception):
+            ExampleConfig(**SONIC_HEDGEHOG).export_to_file(self.config_dir)
+        self.assertEqual(
+                ExampleConfig.from_file(self.config_dir).regex_string,
+                RES_MARIO
+                )
+
+    def test_export_elsewhere(self):
+        first = ExampleConfig(**SUPER_MARIO)
+        first.export_to_file(self.config_dir, shards=4)
+
+        # Exporting somewhere new always writes everything
+        other_dir = join(self.temp_dir, 'other')
+        first.update(**SONIC_HEDGEHOG)
+        first.export_to_file(other_dir, shards=4)
+        self.assertEqual(
+                ExampleConfig.from_file(other_dir).regex_string,
+                ALL_VIDEOGAMES
+                )
+
+class TestUpdateFromItems(unittest.TestCase):
+    def test_items(self):
+        temp = ExampleConfig()
+        items = (pair for pair in [
+            ('str_type', 'hi'),
+            ('list_type', 1),
+            ('list_type', 2),
+            ('regex_string mario', 'luigi'),
+            (('regex_string', 'sonic'), 'tails'),
+            ('regex_tuple www.google.com', 'localhost:443'),
+            ])
+        temp.update_from_items(items)
+
+        self.assertEqual(temp.str_type, 'hi')
+        self.assertEqual(temp.list_type, [1, 2])
+        self.assertEqual(temp.regex_string, ALL_VIDEOGAMES)
+        self.assertEqual(temp.regex_tuple, RES_GOOGLE)
+
+    def test_mapping(self):
+        temp = ExampleConfig()
+        conf = {'str_type': 'hi'}
+        conf.update(FIRST_RE_CONF)
+        temp.update_from_items(conf)
+
+        self.assertEqual(temp.str_type, 'hi')
+        self.assertEqual(temp.regex_string, RES_MARIO)
+        self.assertEqual(temp.regex_tuple, RES_GOOGLE)
+
+    def test_report(self):
+        class DeletingConfig(LamentConfig):
+            @config(str)
+            def name(self, config, obj):
+                return obj
+
+            @regex_config('[a-z]+', str)
+            def hosts(self, config, obj):
+                if obj == '!':
+                    return None
+                return obj
+
+        temp = DeletingConfig(**{'hosts a': 'x'})
+        items = [
+            ('name', 'example'),
+            ('hosts b', 'y'),
+            ('hosts a', '!'),
+            ('hosts c', '!'),
+            ('hosts NOPE', 'z'),
+            (('hosts', 'd', 'e'), 'z'),
+            (('hosts', 5), 'z'),
+            ((['hosts'], 'd'), 'z'),
+            ('unknown', 1),
+            (1, 'x'),
+            (None, 'x'),
+            ]
+        report = temp.update_from_items(items, keys=True)
+
+        self.assertEqual(sorted(report.applied), ['hosts b', 'name'])
+        self.assertEqual(report.deleted, ['hosts a'])
+        self.assertEqual(report.declined, ['hosts c'])
+        self.assertItemsEqual(
+                report.rejected,
+                [('hosts', 'd', 'e'), ('hosts', 5), (['hosts'], 'd'),
+                    'hosts NOPE', 'unknown', 1, None]
+                )
+        self.assertEqual(temp.hosts, {'b': 'y'})
+
+        # Just counts by default
+        temp = DeletingConfig(**{'hosts a': 'x'})
+        self.assertEqual(
+                temp.update_from_items(items),
+                UpdateReport(applied=2, rejected=7, deleted=1, declined=1)
+                )
+
+    def test_raw_input(self):
+        temp = ExampleConfig()
+        temp.update_from_items(
+                (('regex_string', 'h%d' % i), 'd%d' % i) for i in range(100)
+                )
+        temp.update(**GOOGLE)
+
+        # Raw input is only kept where the handler changed it
+        self.assertEqual(list(temp._raw), [('regex_tuple', 'www.google.com')])
+
+        # Values kept as they were are still re-evaluated over new layers
+        temp.add_layer('base', {'regex_string h1': 'layer'})
+        temp.replace_layer('base', dict(YAHOO))
+        self.assertEqual(temp.regex_string['h1'], 'd1')
+        self.assertEqual(temp.regex_tuple, ALL_WEBSITES)
+
+    def test_whitespace(self):
+        temp = ExampleConfig()
+        report = temp.update_from_items([
+            ('regex_string\tmario', 'luigi'),
+            ('regex_string  sonic ', 'tails'),
+            ('regex_string a\tb', 'c'),
+            ('regex_string a b', 'c'),
+            ], keys=True)
+
+        self.assertEqual(temp.regex_string, ALL_VIDEOGAMES)
+        self.assertEqual(
+                sorted(report.rejected),
+                ['regex_string a\tb', 'regex_string a b']
+                )
+
+    def test_single_version(self):
+        temp = ExampleConfig()
+        temp.update_from_items(FIRST_RE_CONF)
+        temp.update_from_items(SECOND_RE_CONF)
+
+        temp.rollback()
+        self.assertEqual(temp.regex_string, RES_MARIO)
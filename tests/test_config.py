@@ -1,11 +1,12 @@
 import unittest
 
-from tempfile import NamedTemporaryFile as TF
+from tempfile import NamedTemporaryFile as TF, mkdtemp
 from json import load
 from os import remove, getcwd
 from os.path import join, isfile
+from shutil import rmtree
 
-from config import ConfigFile
+from config import ConfigFile, ConfigShards
 
 class TestConfigFile(unittest.TestCase):
     def test_no_dir(self):
@@ -73,3 +74,46 @@ class TestConfigFile(unittest.TestCase):
 
         # Clean up
         remove(temp_name)
+
+class TestConfigShards(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.config_dir = join(self.temp_dir, 'sharded')
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_not_sharded(self):
+        with self.assertRaises(Exception):
+            ConfigShards(self.config_dir)
+
+        with self.assertRaises(Exception):
+            ConfigShards('/not/a/real/dir', True)
+
+        self.assertFalse(ConfigShards.is_sharded(self.config_dir))
+
+    def test_round_trip(self):
+        store = ConfigShards(self.config_dir, True, 4)
+        self.assertTrue(store.fresh)
+
+        with store.options() as outp:
+            outp['something'] = 'something else'
+        index = store.shard_of('mario')
+        with store.shard('regex_string', index) as outp:
+            outp['mario'] = 'luigi'
+        store.save_manifest()
+
+        self.assertTrue(ConfigShards.is_sharded(self.config_dir))
+        store = ConfigShards(self.config_dir)
+        self.assertFalse(store.fresh)
+        self.assertEqual(store.shards, 4)
+        self.assertEqual(store.sections, {'regex_string'})
+        self.assertEqual(store.read_options(), {'something': 'something else'})
+        self.assertEqual(
+                store.read_shard('regex_string', index),
+                {'mario': 'luigi'}
+                )
+        self.assertEqual(store.read_shard('regex_string', (index + 1) % 4), {})
+
+        # Changing the number of shards means starting over
+        self.assertTrue(ConfigShards(self.config_dir, True, 8).fresh)
@@ -0,0 +1,88 @@
+import unittest
+
+from persistent import PersistentDict
+
+class Collider(object):
+    # Every instance has the same hash, all the way down the trie
+    def __init__(self, name):
+        self.name = name
+
+    def __hash__(self):
+        return 42
+
+    def __eq__(self, other):
+        return isinstance(other, Collider) and self.name == other.name
+
+    def __ne__(self, other):
+        return not self == other
+
+class TestPersistentDict(unittest.TestCase):
+    def test_dict_behaviour(self):
+        expected = {str(i): i for i in range(1000)}
+        temp = PersistentDict(expected)
+
+        self.assertEqual(len(temp), 1000)
+        self.assertEqual(dict(temp.iteritems()), expected)
+        self.assertEqual(temp['500'], 500)
+        self.assertNotIn('1000', temp)
+
+        temp['500'] = 'five hundred'
+        self.assertEqual(temp['500'], 'five hundred')
+        self.assertEqual(len(temp), 1000)
+
+        for i in range(0, 1000, 2):
+            del temp[str(i)]
+        self.assertEqual(len(temp), 500)
+        self.assertEqual(set(temp), {str(i) for i in range(1, 1000, 2)})
+
+        with self.assertRaises(KeyError):
+            del temp['0']
+
+    def test_copy(self):
+        first = PersistentDict(a=1, b=2)
+        second = first.copy()
+
+        second['a'] = 10
+        del second['b']
+        second['c'] = 3
+
+        self.assertEqual(first, {'a': 1, 'b': 2})
+        self.assertEqual(second, {'a': 10, 'c': 3})
+
+        # Writes to the original don't show up in the copy either
+        first['d'] = 4
+        del first['a']
+        self.assertEqual(first, {'b': 2, 'd': 4})
+        self.assertEqual(second, {'a': 10, 'c': 3})
+
+    def test_sharing(self):
+        first = PersistentDict((str(i), i) for i in range(10000))
+        second = first.copy()
+        second['500'] = 'five hundred'
+        del second['501']
+
+        # Only the leaves holding changed keys get copied
+        shared = set(map(id, first._leaves())) & set(map(id, second._leaves()))
+        leaves = list(first._leaves())
+        self.assertGreaterEqual(len(shared), len(leaves) - 2)
+        self.assertEqual(first['500'], 500)
+        self.assertIn('501', first)
+
+    def test_collisions(self):
+        mario, luigi = Collider('mario'), Collider('luigi')
+        temp = PersistentDict()
+        temp[mario] = 1
+        temp[luigi] = 2
+
+        self.assertEqual(temp[mario], 1)
+        self.assertEqual(temp[luigi], 2)
+        self.assertEqual(len(temp), 2)
+
+        del temp[mario]
+        self.assertNotIn(mario, temp)
+        self.assertEqual(temp[luigi], 2)
+
+        # Far more than fit in one leaf
+        many = PersistentDict((Collider(str(i)), i) for i in range(100))
+        self.assertEqual(len(many), 100)
+        self.assertEqual(many[Collider('99')], 99)